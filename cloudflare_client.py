@@ -1,87 +1,164 @@
 # cloudflare_client.py
 import aiohttp # New import
 import asyncio # New import
-import json
-import time # Still used for sleep
+import logging
+import orjson
+import random
+from errors import FatalConfigError
 from config import (
     CLOUDFLARE_API_TOKEN, CLOUDFLARE_ZONE_ID,
-    LOG_FIELDS, LOG_FILTER_JSON_STRING, LOG_SAMPLE_RATE,
-    RETRY_DELAY_SECONDS
+    INSTANT_LOGS_PAYLOAD_BYTES,
+    RETRY_DELAY_SECONDS, MAX_RETRY_DELAY_SECONDS, SESSION_ACTIVE_RETRY_DELAY_SECONDS,
+    SESSION_RENEWAL_RETRY_DELAY_SECONDS, SESSION_RENEWAL_FAST_RETRIES
 )
 
+logger = logging.getLogger(__name__)
+
 CLOUDFLARE_API_BASE_URL = "https://api.cloudflare.com/client/v4"
 
+# How create_instant_log_session reacts to a non-2xx status. Statuses not listed are retried with backoff.
+_STATUS_ACTIONS = {
+    401: "abort",       # Token is invalid or expired, retrying cannot help
+    403: "abort",       # Token lacks permission for Instant Logs on this zone
+    429: "retry_after", # Rate limited, wait as long as Cloudflare asks
+}
+
+def _parse_error_body(response_text: str) -> dict:
+    """Best-effort parse of a Cloudflare error response body, {} if it is not a JSON object."""
+    try:
+        data = orjson.loads(response_text)
+    except orjson.JSONDecodeError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+# Auth and timeout are passed per API request, not set on the shared session, since the
+# same session also carries the long-lived Instant Logs WebSocket.
+_API_HEADERS = {
+    "Authorization": f"Bearer {CLOUDFLARE_API_TOKEN}",
+    "Content-Type": "application/json"
+}
+_API_TIMEOUT = aiohttp.ClientTimeout(total=30)
+
+# One pooled session shared by every Cloudflare call in the process, so retries, session
+# renewals and WebSocket reconnects reuse warm TCP/TLS connections instead of handshaking again.
+_shared_session = None
+_shared_session_lock = asyncio.Lock()
+
+async def get_shared_session():
+    """Returns the module-level aiohttp ClientSession, creating it on first use."""
+    global _shared_session
+    async with _shared_session_lock:
+        if _shared_session is None or _shared_session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=100,
+                limit_per_host=20,
+                keepalive_timeout=60,
+                ttl_dns_cache=600,
+                resolver=aiohttp.AsyncResolver(), # aiodns, from aiohttp[speedups]
+            )
+            _shared_session = aiohttp.ClientSession(connector=connector)
+    return _shared_session
+
+async def close_shared_session():
+    """Closes the module-level aiohttp ClientSession if it is open."""
+    global _shared_session
+    if _shared_session and not _shared_session.closed:
+        await _shared_session.close()
+        logger.info("aiohttp session closed.")
+    _shared_session = None
+
 class CloudflareLogSessionManager:
     def __init__(self):
         if not CLOUDFLARE_API_TOKEN or not CLOUDFLARE_ZONE_ID:
-            raise ValueError("Cloudflare API Token or Zone ID not configured.")
+            raise FatalConfigError("Cloudflare API Token or Zone ID not configured.")
         
-        self.headers = {
-            "Authorization": f"Bearer {CLOUDFLARE_API_TOKEN}",
-            "Content-Type": "application/json"
-        }
         self.zone_id = CLOUDFLARE_ZONE_ID
-        self._session = None # For aiohttp ClientSession
+        self._session = None # Reference to the shared aiohttp ClientSession
 
     async def _get_aiohttp_session(self):
-        """Creates or returns an existing aiohttp ClientSession."""
-        if self._session is None or self._session.closed:
-            self._session = aiohttp.ClientSession(headers=self.headers)
+        """Returns the shared aiohttp ClientSession."""
+        self._session = await get_shared_session()
         return self._session
 
     async def close_aiohttp_session(self):
-        """Closes the aiohttp ClientSession."""
-        if self._session and not self._session.closed:
-            await self._session.close()
-            self._session = None
-            print("aiohttp session closed.")
+        """Closes the shared aiohttp ClientSession."""
+        await close_shared_session()
+        self._session = None
 
-    async def create_instant_log_session(self): # Now an async method
+    async def create_instant_log_session(self, renewal: bool = False): # Now an async method
         """
         Creates a new Cloudflare Instant Logs job and returns the WebSocket URL.
         Retries on failure. Uses aiohttp for async requests.
+        With renewal, the session just closed by this process may still count as active
+        for a moment, so the first few "already active" answers are retried quickly instead of waiting it out.
         """
         url = f"{CLOUDFLARE_API_BASE_URL}/zones/{self.zone_id}/logpush/edge/jobs"
-        payload = {
-            "fields": LOG_FIELDS,
-            "sample": LOG_SAMPLE_RATE,
-            "filter": LOG_FILTER_JSON_STRING,
-            "kind": "instant-logs"
-        }
-        
         session = await self._get_aiohttp_session()
+        attempt = 0
 
         while True: 
-            print("Attempting to create new Cloudflare Instant Logs session (async)...")
+            logger.info("Attempting to create new Cloudflare Instant Logs session (async)...")
+            response_text = None # Only read as text on the error paths
+            session_already_active = False
+            status_action = None
+            retry_after = None
             try:
-                async with session.post(url, json=payload, timeout=30) as response:
-                    response_text = await response.text() # Get text for debugging if json fails
-                    response.raise_for_status() 
-                    data = await response.json()
+                async with session.post(url, data=INSTANT_LOGS_PAYLOAD_BYTES, headers=_API_HEADERS, timeout=_API_TIMEOUT) as response:
+                    status = response.status
+                    if status < 300:
+                        try:
+                            data = await response.json(loads=orjson.loads, content_type=None)
+                        except orjson.JSONDecodeError:
+                            response_text = await response.text()
+                            raise
+                    else:
+                        # Error statuses are dispatched through _STATUS_ACTIONS instead of raise_for_status()
+                        status_action = _STATUS_ACTIONS.get(status, "retry")
+                        retry_after = response.headers.get("Retry-After")
+                        response_text = await response.text()
+                        data = _parse_error_body(response_text)
 
-                if data.get("success") and data.get("result", {}).get("destination_conf"):
+                if status_action is None and data.get("success") and data.get("result", {}).get("destination_conf"):
                     ws_url = data["result"]["destination_conf"]
                     job_id = data["result"].get("id", "N/A")
                     session_id_from_url = ws_url.split('/')[-1]
-                    print(f"Successfully created Instant Logs job. Session ID: {session_id_from_url} (Job ID: {job_id})")
-                    print(f"WebSocket URL: {ws_url}")
+                    logger.info("Successfully created Instant Logs job. Session ID: %s (Job ID: %s)", session_id_from_url, job_id)
+                    logger.info("WebSocket URL: %s", ws_url)
                     return ws_url, session_id_from_url
                 else:
                     error_messages = data.get('errors', [{'message': 'Unknown error from Cloudflare API.'}])
-                    print(f"Error creating Instant Logs session: {error_messages}")
+                    if status_action is None:
+                        logger.warning("Error creating Instant Logs session: %s", error_messages)
+                    else:
+                        logger.warning("HTTP %s when creating Instant Logs session - Response: %s", status, response_text or 'N/A')
                     if any(err.get("code") == 1303 for err in error_messages if isinstance(err, dict)):
-                        print("An Instant Log session is already active for this zone. Waiting before retry...")
+                        session_already_active = True
+                        logger.info("An Instant Log session is already active for this zone. Waiting before retry...")
 
-            except aiohttp.ClientResponseError as e: # Specific error for bad status codes
-                print(f"HTTPError (aiohttp) when creating Instant Logs session: {e.status} - {e.message} - Response: {response_text if 'response_text' in locals() else 'N/A'}")
-            except aiohttp.ClientError as e: # Catches other client errors like connection issues
-                print(f"ClientError (aiohttp) when creating Instant Logs session: {e}")
+            except aiohttp.ClientError as e: # Catches client errors like connection issues
+                logger.warning("ClientError (aiohttp) when creating Instant Logs session: %s", e)
             except asyncio.TimeoutError:
-                print(f"Timeout when creating Instant Logs session with aiohttp.")
-            except json.JSONDecodeError as e:
-                 print(f"Failed to decode JSON response from Cloudflare API: {e}. Response text: {response_text if 'response_text' in locals() else 'N/A'}")
+                logger.warning("Timeout when creating Instant Logs session with aiohttp.")
+            except orjson.JSONDecodeError as e:
+                 logger.warning("Failed to decode JSON response from Cloudflare API: %s. Response text: %s", e, response_text or 'N/A')
             except Exception as e:
-                print(f"An unexpected error occurred in create_instant_log_session (async): {e}")
+                logger.error("An unexpected error occurred in create_instant_log_session (async): %s", e)
+
+            if status_action == "abort":
+                raise FatalConfigError(f"Cloudflare API rejected the Instant Logs request (HTTP {status}). Check CLOUDFLARE_API_TOKEN and its permissions.")
             
-            print(f"Retrying session creation in {RETRY_DELAY_SECONDS} seconds...")
-            await asyncio.sleep(RETRY_DELAY_SECONDS) # Use asyncio.sleep
\ No newline at end of file
+            # Capped exponential backoff with full jitter so concurrent workers don't retry in lockstep
+            delay = min(RETRY_DELAY_SECONDS * 2 ** min(attempt, 10), MAX_RETRY_DELAY_SECONDS) * random.random()
+            if session_already_active and renewal and attempt < SESSION_RENEWAL_FAST_RETRIES:
+                # Likely our own previous session, closed moments ago. If it is still active after
+                # a few quick tries, another session holds the zone: fall back to the usual wait.
+                delay = SESSION_RENEWAL_RETRY_DELAY_SECONDS
+            elif session_already_active:
+                # The active session has to expire first, retrying sooner cannot succeed
+                delay = max(SESSION_ACTIVE_RETRY_DELAY_SECONDS, delay)
+            if status_action == "retry_after" and retry_after and retry_after.isdigit():
+                delay = float(retry_after)
+            attempt += 1
+
+            logger.info("Retrying session creation in %.1f seconds...", delay)
+            await asyncio.sleep(delay) # Use asyncio.sleep
\ No newline at end of file
@@ -1,5 +1,6 @@
 # config.py
 import os
+import orjson
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -43,19 +44,56 @@ LOG_FIELDS = ",".join(LOG_FIELDS_LIST)
 LOG_FILTER_JSON_STRING = "" # Start broad, refine later
 LOG_SAMPLE_RATE = 100
 
+# Request body for creating an Instant Logs job, serialized once and reused on every retry
+INSTANT_LOGS_PAYLOAD_BYTES = orjson.dumps({
+    "fields": LOG_FIELDS,
+    "sample": LOG_SAMPLE_RATE,
+    "filter": LOG_FILTER_JSON_STRING,
+    "kind": "instant-logs"
+})
+
+# permessage-deflate window bits offered on the log WebSocket (0 disables compression).
+# Off by default: inflating every frame costs more receive-loop CPU than the bandwidth it saves.
+WEBSOCKET_COMPRESS = 0
+
 # --- Session Management ---
-SESSION_RENEWAL_INTERVAL_MINUTES = 55
+SESSION_RENEWAL_INTERVAL_MINUTES = 55 # The receiver ends each Instant Logs session after this long and a new one is created
 
 # --- Log Batching for AI Analysis ---
 MAX_LOG_BATCH_SIZE = 15  # Adjust based on typical log entry size and Gemini token limits
 BATCH_FLUSH_INTERVAL_SECONDS = 15 # Adjust
+LOG_INGEST_QUEUE_MAX_MESSAGES = 10000 # WebSocket messages waiting for the processor; the oldest is dropped when full
+
+# Several flushed batches (windows) can share one Gemini call to amortize its round trip
+GEMINI_BATCH_MAX_WINDOWS = int(os.getenv("GEMINI_BATCH_MAX_WINDOWS", "5"))
+GEMINI_BATCH_WAIT_MS = int(os.getenv("GEMINI_BATCH_WAIT_MS", "200")) # Max wait for more windows before calling Gemini
+GEMINI_MAX_CONCURRENT_CALLS = int(os.getenv("GEMINI_MAX_CONCURRENT_CALLS", "4")) # Gemini calls in flight at once
+GEMINI_PROMPT_MAX_GROUPS_PER_WINDOW = 50 # Most frequent deduplicated entries sent per window, the rest are summarized
+WINDOW_QUEUE_MAX_WINDOWS = 100 # Windows waiting for Gemini; the oldest is dropped when analysis falls this far behind
+
+# A flush whose top client IPs overlap the previous window's by more than this (Jaccard)
+# is held back and merged into the next window, for at most the max delay.
+WINDOW_COALESCE_JACCARD_THRESHOLD = 0.7
+WINDOW_COALESCE_MAX_DELAY_SECONDS = 30
+WINDOW_COALESCE_MAX_ENTRIES = 10 * MAX_LOG_BATCH_SIZE # A held buffer this large is flushed right away instead
+
+# --- Application Logging ---
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 
 # --- Output Log File (Optional for raw logs) ---
 OUTPUT_LOG_FILE = "received_cloudflare_logs.ndjson" 
+OUTPUT_LOG_WRITE_INTERVAL_SECONDS = 0.05 # Frames queued within this interval share one write
+OUTPUT_LOG_QUEUE_MAX_LINES = 10000 # Frames beyond this are dropped while the disk falls behind
 
 # --- Terraform Configuration ---
 TFVARS_FILE_PATH = "cloudflare/zones/appointy_ai/appointy_ai.tfvars"
 
 # --- Delays ---
-RETRY_DELAY_SECONDS = 30
-WEBSOCKET_ERROR_RETRY_DELAY_SECONDS = 10
\ No newline at end of file
+RETRY_DELAY_SECONDS = 30 # Base delay for the Cloudflare session retry backoff
+MAX_RETRY_DELAY_SECONDS = 300 # Cap for the exponential backoff
+SESSION_ACTIVE_RETRY_DELAY_SECONDS = 60 # Minimum wait when another Instant Logs session is still active (code 1303)
+SESSION_RENEWAL_RETRY_DELAY_SECONDS = 2 # Retry delay for code 1303 right after renewing, while our closed session is released
+SESSION_RENEWAL_FAST_RETRIES = 3 # Attempts retried that fast; later 1303s wait SESSION_ACTIVE_RETRY_DELAY_SECONDS
+WEBSOCKET_ERROR_RETRY_DELAY_SECONDS = 10
+WEBSOCKET_INITIAL_RETRY_DELAY_SECONDS = 1 # First receiver reconnect delay, doubled (with jitter) per failed attempt
+WEBSOCKET_MAX_RETRY_DELAY_SECONDS = 60 # Cap for the receiver reconnect backoff
@@ -0,0 +1,7 @@
+# errors.py
+
+class FatalConfigError(ValueError):
+    """
+    Missing configuration or credentials the API rejected. Retrying cannot help,
+    so main_logger stops the application with a non-zero exit code.
+    """
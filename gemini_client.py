@@ -1,113 +1,205 @@
 # gemini_client.py
-import google.generativeai as genai
-import json
-from config import GEMINI_API_KEY, GEMINI_MODEL_NAME
+import asyncio
+import contextlib
+import logging
+from google import genai
+from google.genai import types
+import orjson
+from errors import FatalConfigError
+from config import GEMINI_API_KEY, GEMINI_MODEL_NAME, GEMINI_PROMPT_MAX_GROUPS_PER_WINDOW
+from log_filter import is_interesting, dedupe_entries, match_signatures
 
-class GeminiClient:
-    def __init__(self):
-        if not GEMINI_API_KEY:
-            raise ValueError("GEMINI_API_KEY not configured.")
-
-        genai.configure(api_key=GEMINI_API_KEY)
-
-        self.model = genai.GenerativeModel(
-            model_name=GEMINI_MODEL_NAME,
-            tools=[{
-                "function_declarations": [
-                    {
-                        "name": "report_suspicious_activity",
-                        "description": "Reports distinct suspicious entities or behaviors found in HTTP request logs.",
-                        "parameters": {
+logger = logging.getLogger(__name__)
+
+# Tool schema shared by every GeminiClient instance
+_TOOL_SCHEMA = {
+    "function_declarations": [
+        {
+            "name": "report_suspicious_activity",
+            "description": "Reports distinct suspicious entities or behaviors found in HTTP request logs.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "threats": {
+                        "type": "array",
+                        "description": "A list of distinct suspicious entities and reasoning.",
+                        "items": {
                             "type": "object",
                             "properties": {
-                                "threats": {
-                                    "type": "array",
-                                    "description": "A list of distinct suspicious entities and reasoning.",
-                                    "items": {
-                                        "type": "object",
-                                        "properties": {
-                                            "entity_type": {
-                                                "type": "string",
-                                                "description": "The kind of suspicious entity (IP, UserAgent, ASN, URI_Pattern, RequestPattern)."
-                                            },
-                                            "entity_value": {
-                                                "type": "string",
-                                                "description": "The exact value of the suspicious entity (e.g., IP address, UserAgent string)."
-                                            },
-                                            "reason": {
-                                                "type": "string",
-                                                "description": "Concise reason why this entity is suspicious."
-                                            },
-                                            "suggested_action": {
-                                                "type": "string",
-                                                "description": "Recommended WAF action (e.g., block, challenge)."
-                                            },
-                                            "confidence_score": {
-                                                "type": "number",
-                                                "description": "A float between 0 and 1 representing the confidence level."
-                                            }
-                                        },
-                                        "required": ["entity_type", "entity_value", "reason", "suggested_action", "confidence_score"]
-                                    }
+                                "entity_type": {
+                                    "type": "string",
+                                    "description": "The kind of suspicious entity (IP, UserAgent, ASN, URI_Pattern, RequestPattern)."
+                                },
+                                "entity_value": {
+                                    "type": "string",
+                                    "description": "The exact value of the suspicious entity (e.g., IP address, UserAgent string)."
+                                },
+                                "reason": {
+                                    "type": "string",
+                                    "description": "Concise reason why this entity is suspicious."
+                                },
+                                "suggested_action": {
+                                    "type": "string",
+                                    "description": "Recommended WAF action (e.g., block, challenge)."
+                                },
+                                "confidence_score": {
+                                    "type": "number",
+                                    "description": "A float between 0 and 1 representing the confidence level."
+                                },
+                                "source_window_id": {
+                                    "type": "integer",
+                                    "description": "The window_id of the log window the entity was found in."
                                 }
                             },
-                            "required": ["threats"]
+                            "required": ["entity_type", "entity_value", "reason", "suggested_action", "confidence_score", "source_window_id"]
                         }
                     }
-                ]
-            }]
-        )
+                },
+                "required": ["threats"]
+            }
+        }
+    ]
+}
 
-        self.chat_session = self.model.start_chat()
+# Request config shared by every call, validated once instead of per request.
+# Gemini must always answer through the reporting tool, so every response is structured.
+_GENERATE_CONFIG = types.GenerateContentConfig(
+    tools=[types.Tool.model_validate(_TOOL_SCHEMA)],
+    tool_config=types.ToolConfig(
+        function_calling_config=types.FunctionCallingConfig(
+            mode="ANY",
+            allowed_function_names=["report_suspicious_activity"]
+        )
+    ),
+    # The declaration has no Python implementation; the caller handles the call itself
+    automatic_function_calling=types.AutomaticFunctionCallingConfig(disable=True),
+)
 
-    async def analyze_logs(self, log_entries: list):
-        """
-        Analyzes a batch of log entries using Gemini to identify suspicious activity.
-        """
-        if not log_entries:
-            return []
+# Cloudflare WAF actions a model suggestion may name; anything else is downgraded to "challenge"
+_ALLOWED_ACTIONS = frozenset({"block", "challenge", "managed_challenge", "js_challenge"})
 
-        log_text = json.dumps(log_entries, indent=2)
-        prompt =  f"""
+# Static instructions, built once; only the log JSON changes between batches
+_PROMPT_PREFIX = """
 You are an expert cybersecurity threat detection analyst. Your primary function is to meticulously analyze
 the provided batch of Cloudflare HTTP request log entries to identify sophisticated and emerging threats,
 including but not limited to: coordinated dictionary attacks (e.g., multiple POSTs to /login, /admin, /signin, /wp-login.php from an IP/ASN with many 4xx responses),
-SQL injection attempts (e.g., URI queries containing 'UNION SELECT', 'DROP TABLE', or SQL-like syntax),
-Local/Remote File Inclusion (e.g., '../', 'etc/passwd'),
-Cross-Site Scripting (XSS) payloads (e.g., '<script>', 'onerror='),
-User-Agents known to be scanners or malicious bots (e.g., 'sqlmap', 'Nmap Scripting Engine', 'masscan', 'dirb', 'nikto', 'Havij', known bad bot strings),
+obfuscated or novel injection payloads that do not match common signatures,
+bots whose User-Agent or request pattern looks automated,
 or IPs/ASNs generating an unusually high rate of HTTP error codes (401, 403, 404, 429, 5xx) particularly to sensitive paths.
-Also, consider IPs making requests to common vulnerability probing paths (e.g., '/.env', '/config/backup.zip', '/phpmyadmin/'),
+Also, consider IPs making requests to common vulnerability probing paths (e.g., '/config/backup.zip', '/wp-admin/', '/.git/'),
 or IPs exhibiting a high request rate that could indicate a denial-of-service or brute-force attack.
+Requests matching well-known SQLi, XSS, path traversal and scanner signatures have already been reported and are not included.
 
 For each distinct suspicious activity or entity you identify with high confidence (e.g., confidence > 0.7),
 YOU MUST use the 'report_suspicious_activity' tool. Provide the entity type (IP, UserAgent, ASN, URI_Pattern for specific paths, RequestPattern for method+path),
-the entity value, a concise reason based on the log data (e.g., 'Multiple 403s to /admin from this IP', 'High request rate from IP', 'SQLi signature in URI query', 'User agent is a known scanner'),
+the entity value, a concise reason based on the log data (e.g., 'Multiple 403s to /admin from this IP', 'High request rate from IP', 'Same login POST repeated from many IPs of one ASN', 'Encoded payload variants probing one parameter'),
 a suggested Cloudflare WAF action ('block', 'challenge'), and a confidence_score.
 
+Only entries with an error status, a firewall/WAF action, a missing or scanner-like User-Agent or a suspicious URI are included.
+Entries with the same ClientIP, ClientRequestURI and EdgeResponseStatus are collapsed into one;
+RequestCount tells how many requests each entry stands for.
+Only the most frequent entries of a window are listed; omitted_entries and omitted_requests count the rest.
+Logs are grouped into windows collected at different times; report the window_id of each finding as source_window_id.
+
 Log Data Batch Sample (focus your analysis on these entries):
 ```json
-{log_text}
-```"""
+"""
+_PROMPT_SUFFIX = "\n```"
 
-        try:
-            response = await self.chat_session.send_message_async(prompt)
+def _prepare_windows(windows: list):
+    """
+    Runs the local analysis of the windows. Returns (signature_threats, prompt), where
+    prompt is None when no entries are left that need Gemini.
+    """
+    signature_threats = []
+    tagged_windows = []
+    for window_id, log_entries in enumerate(windows):
+        # Known attack signatures are reported directly; only the residual goes to Gemini
+        threats, residual = match_signatures(log_entries)
+        for threat in threats:
+            threat["source_window_id"] = window_id
+        signature_threats.extend(threats)
+
+        # Drop plainly benign traffic and collapse repeats before paying for an LLM call
+        candidates = dedupe_entries([entry for entry in residual if is_interesting(entry)])
+        if not candidates:
+            continue
+        tagged_window = {"window_id": window_id, "logs": candidates}
+        if len(candidates) > GEMINI_PROMPT_MAX_GROUPS_PER_WINDOW:
+            # Keep the heaviest hitters, so a long tail of one-off requests cannot crowd them out
+            candidates.sort(key=lambda candidate: candidate["RequestCount"], reverse=True)
+            omitted = candidates[GEMINI_PROMPT_MAX_GROUPS_PER_WINDOW:]
+            tagged_window["logs"] = candidates[:GEMINI_PROMPT_MAX_GROUPS_PER_WINDOW]
+            tagged_window["omitted_entries"] = len(omitted)
+            tagged_window["omitted_requests"] = sum(candidate["RequestCount"] for candidate in omitted)
+        tagged_windows.append(tagged_window)
+
+    if not tagged_windows:
+        return signature_threats, None
 
-            if response.candidates and response.candidates[0].content.parts:
-                first_part = response.candidates[0].content.parts[0]
-                if hasattr(first_part, 'function_call') and hasattr(first_part.function_call, 'name') and first_part.function_call.name == "report_suspicious_activity":
-                    tool_call = first_part.function_call
-                    threat_arguments = tool_call.args
-                    return threat_arguments.get("threats", [])
-                else:
-                    print("Gemini analysis completed, no threats reported by the model via function call.")
-                    return []
+    # Compact JSON: indentation only costs prompt tokens
+    log_text = orjson.dumps(tagged_windows).decode()
+    return signature_threats, _PROMPT_PREFIX + log_text + _PROMPT_SUFFIX
+
+class GeminiClient:
+    def __init__(self):
+        if not GEMINI_API_KEY:
+            raise FatalConfigError("GEMINI_API_KEY not configured.")
+
+        # One client, and with it one pooled httpx connection, for the process lifetime.
+        # HTTP/2 lets concurrent analysis calls share a single TLS connection.
+        self.client = genai.Client(
+            api_key=GEMINI_API_KEY,
+            http_options=types.HttpOptions(async_client_args={"http2": True})
+        )
+
+    async def analyze_windows(self, windows: list):
+        """
+        Analyzes several batches (windows) of log entries with a single Gemini call.
+        Every returned threat carries source_window_id, the index of its window in `windows`.
+        """
+        # Signature matching, filtering and prompt serialization are CPU-bound; run them in a
+        # worker thread so the event loop keeps draining the WebSocket meanwhile
+        signature_threats, prompt = await asyncio.to_thread(_prepare_windows, windows)
+        if prompt is None:
+            total_entries = sum(len(log_entries) for log_entries in windows)
+            logger.info("No suspicious entries left for Gemini among %d logs, skipping Gemini analysis.", total_entries)
+            return signature_threats
+
+        try:
+            # Calls are stateless; a chat session would resend its whole history every time.
+            # The response is streamed so the function call is used as soon as it arrives,
+            # without waiting for any text the model may append after it.
+            # aclosing() ends the HTTP stream on an early return instead of leaving it to the GC.
+            stream = await self.client.aio.models.generate_content_stream(
+                model=GEMINI_MODEL_NAME, contents=prompt, config=_GENERATE_CONFIG
+            )
+            received_parts = False
+            async with contextlib.aclosing(stream):
+                async for chunk in stream:
+                    if not (chunk.candidates and chunk.candidates[0].content and chunk.candidates[0].content.parts):
+                        continue
+                    received_parts = True
+                    for part in chunk.candidates[0].content.parts:
+                        function_call = part.function_call
+                        if function_call and function_call.name == "report_suspicious_activity":
+                            threat_arguments = function_call.args or {} # Already plain dicts and lists
+                            model_threats = threat_arguments.get("threats", [])
+                            for threat in model_threats:
+                                if threat.get("suggested_action") not in _ALLOWED_ACTIONS:
+                                    threat["suggested_action"] = "challenge"
+                            return signature_threats + model_threats
 
-            print("Gemini response structure unexpected or empty (no candidates/parts).")
-            return []
+            if received_parts:
+                logger.info("Gemini analysis completed, no threats reported by the model via function call.")
+            else:
+                logger.warning("Gemini response structure unexpected or empty (no candidates/parts).")
+            return signature_threats
 
         except Exception as e:
-            print(f"Error during Gemini analysis: {e}")
-            import traceback
-            traceback.print_exc()
-            return []
+            # Gemini errors arrive in bursts (quota, 5xx); only pay for the stack trace when debugging
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.exception("Error during Gemini analysis: %s", e)
+            else:
+                logger.error("Error during Gemini analysis: %s", e)
+            return signature_threats
@@ -0,0 +1,34 @@
+# log_entry.py
+from typing import List, Optional, Union
+import msgspec
+
+class LogEntry(msgspec.Struct, omit_defaults=True):
+    """
+    One Cloudflare Instant Logs record with the fields from LOG_FIELDS_LIST.
+    Fields missing from a record default to None (or an empty list).
+    """
+    RayID: Optional[str] = None
+    EdgeStartTimestamp: Union[int, str, None] = None
+    ClientIP: Optional[str] = None
+    ClientRequestHost: Optional[str] = None
+    ClientRequestMethod: Optional[str] = None
+    ClientRequestURI: Optional[str] = None
+    EdgeResponseStatus: Optional[int] = None
+    ClientCountry: Optional[str] = None
+    ClientASN: Optional[int] = None
+    ClientASNDescription: Optional[str] = None
+    ClientRequestUserAgent: Optional[str] = None
+    FirewallMatchesActions: List[str] = []
+    FirewallMatchesRuleIDs: List[str] = []
+    FirewallMatchesSources: List[str] = []
+    WAFAction: Optional[str] = None
+    WAFRuleID: Optional[str] = None
+    WAFRuleMessage: Optional[str] = None
+    SecurityLevelAction: Optional[str] = None
+    ClientRequestReferer: Optional[str] = None
+    ClientRequestBytes: Optional[int] = None
+    EdgeResponseBytes: Optional[int] = None
+
+# Schema-driven decoder, built once and reused for every record.
+# Unknown keys are skipped during decoding.
+LOG_ENTRY_DECODER = msgspec.json.Decoder(LogEntry)
@@ -0,0 +1,106 @@
+# log_filter.py
+import re
+from urllib.parse import unquote_plus
+import msgspec
+from log_entry import LogEntry
+
+# Cheap URI hints that a request deserves a closer look, matched against the decoded URI
+_SUSPICIOUS_URI_RE = re.compile(r"(?i)(\.\./|\.env|select|<script|etc/passwd|phpmyadmin|wp-login\.php|'\s*(or|and)\s)")
+
+# Scanner tools that announce themselves in the user agent
+_SUSPICIOUS_UA_RE = re.compile(r"(?i)(sqlmap|nikto|nmap|masscan|dirb|havij)")
+
+# WAFAction values that mean the managed rules did not act on the request
+_BENIGN_WAF_ACTIONS = (None, "", "allow", "unknown")
+
+def _decoded_uri(log_entry: LogEntry) -> str:
+    """
+    Returns the request URI percent- and plus-decoded, since attack payloads usually arrive
+    encoded (%3Cscript%3E, ..%2F, union+select). Plain URIs are returned without a decode pass.
+    """
+    uri = log_entry.ClientRequestURI or ""
+    if "%" in uri or "+" in uri:
+        return unquote_plus(uri)
+    return uri
+
+def is_interesting(log_entry: LogEntry) -> bool:
+    """Returns True if a log entry carries any signal worth sending to Gemini."""
+    status = log_entry.EdgeResponseStatus
+    if status is not None and status >= 400:
+        return True
+    if log_entry.FirewallMatchesActions:
+        return True
+    if log_entry.WAFAction not in _BENIGN_WAF_ACTIONS:
+        return True
+    user_agent = log_entry.ClientRequestUserAgent or ""
+    if len(user_agent) < 10 or _SUSPICIOUS_UA_RE.search(user_agent):
+        return True # Missing, truncated or scanner user agent
+    return _SUSPICIOUS_URI_RE.search(_decoded_uri(log_entry)) is not None
+
+def dedupe_entries(log_entries: list) -> list:
+    """
+    Collapses entries sharing (ClientIP, ClientRequestURI, EdgeResponseStatus)
+    into the first exemplar, returned as a dict with a RequestCount of how many it stands for.
+    """
+    groups = {}
+    for entry in log_entries:
+        key = (entry.ClientIP, entry.ClientRequestURI, entry.EdgeResponseStatus)
+        group = groups.get(key)
+        if group is None:
+            groups[key] = [entry, 1]
+        else:
+            group[1] += 1
+    return [dict(msgspec.to_builtins(entry), RequestCount=count) for entry, count in groups.values()]
+
+# Deterministic attack signatures. A hit is reported directly instead of asking Gemini.
+# Scanner names only count in the user agent: in a URI they are often just content,
+# such as /blog/nmap-tutorial.
+THREAT_UA_SIGNATURE_RE = _SUSPICIOUS_UA_RE
+THREAT_URI_SIGNATURE_RE = re.compile(
+    r"(?i)(union\s+select|drop\s+table|\.\./|etc/passwd|<script|onerror=|/\.env|/phpmyadmin/)"
+)
+
+def match_signatures(log_entries: list):
+    """
+    Scans each entry's user agent against THREAT_UA_SIGNATURE_RE and its
+    decoded URI against THREAT_URI_SIGNATURE_RE.
+    Returns (threats, residual): one threat report per matched entity, and
+    the entries without a signature hit that still need AI analysis.
+    """
+    threats = {}
+    residual = []
+    for entry in log_entries:
+        user_agent = entry.ClientRequestUserAgent or ""
+        match = THREAT_UA_SIGNATURE_RE.search(user_agent)
+        if match:
+            key = ("UserAgent", user_agent)
+            reason = f"User agent matches known scanner signature '{match.group(0)}'"
+        else:
+            match = THREAT_URI_SIGNATURE_RE.search(_decoded_uri(entry))
+            if match is None:
+                residual.append(entry)
+                continue
+            key = ("IP", entry.ClientIP or "N/A")
+            reason = f"Attack signature '{match.group(0)}' in request URI"
+
+        if key not in threats:
+            threats[key] = {
+                "entity_type": key[0],
+                "entity_value": key[1],
+                "reason": reason,
+                "suggested_action": "block",
+                "confidence_score": 0.95,
+            }
+    return list(threats.values()), residual
+
+def has_signal(log_entries: list) -> bool:
+    """
+    Returns True if any entry is worth analyzing at all: interesting to Gemini
+    or matching a deterministic threat signature.
+    """
+    for entry in log_entries:
+        if is_interesting(entry):
+            return True
+        if THREAT_URI_SIGNATURE_RE.search(_decoded_uri(entry)):
+            return True
+    return False
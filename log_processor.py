@@ -1,116 +1,355 @@
 # log_processor.py
 import asyncio
+import logging
+import os
 import time
-import json
+from collections import Counter
+import aiofiles
 from gemini_client import GeminiClient
-from config import MAX_LOG_BATCH_SIZE, BATCH_FLUSH_INTERVAL_SECONDS, OUTPUT_LOG_FILE # Import OUTPUT_LOG_FILE
+from log_filter import has_signal
+from config import (
+    MAX_LOG_BATCH_SIZE, BATCH_FLUSH_INTERVAL_SECONDS, LOG_INGEST_QUEUE_MAX_MESSAGES, OUTPUT_LOG_FILE,
+    GEMINI_BATCH_MAX_WINDOWS, GEMINI_BATCH_WAIT_MS, GEMINI_MAX_CONCURRENT_CALLS, WINDOW_QUEUE_MAX_WINDOWS,
+    OUTPUT_LOG_WRITE_INTERVAL_SECONDS, OUTPUT_LOG_QUEUE_MAX_LINES,
+    WINDOW_COALESCE_JACCARD_THRESHOLD, WINDOW_COALESCE_MAX_DELAY_SECONDS, WINDOW_COALESCE_MAX_ENTRIES
+)
+
+logger = logging.getLogger(__name__)
+
+def _top_client_ips(log_entries: list, top_n: int = 20) -> frozenset:
+    """Returns the top_n most frequent ClientIPs of a window, used as its fingerprint."""
+    return frozenset(ip for ip, _ in Counter(entry.ClientIP for entry in log_entries).most_common(top_n))
 
 class LogProcessor:
     def __init__(self):
         self.gemini_client = GeminiClient()
         self._log_buffer = []
-        self._last_flush_time = time.time()
+        self._last_flush_time = time.monotonic() # Monotonic, so clock adjustments cannot skew the flush interval
         self._processing_task = None # To hold the background task
+        # Decoded entries of each WebSocket message, handed over by the receiver without blocking it
+        self.queue = asyncio.Queue(maxsize=LOG_INGEST_QUEUE_MAX_MESSAGES)
+        self._ingest_task = None # Moves queued entries into the buffer
+        self.dropped_log_messages = 0
+        self._flush_now = asyncio.Event() # Set once the buffer reaches MAX_LOG_BATCH_SIZE
+        # Flushed batches (windows) waiting for Gemini, bounded so a slow Gemini cannot grow memory without limit
+        self._window_queue = asyncio.Queue(maxsize=WINDOW_QUEUE_MAX_WINDOWS)
+        self.dropped_windows = 0
+        self._last_window_ips = frozenset() # Fingerprint of the last window queued for Gemini
+        self._deferred_since = None # When the current buffer was first held back for coalescing
+        self.coalesced_flushes = 0 # Flushes merged into a later window instead of analyzed alone
+        self._held_entries = 0 # Buffer size when it was last held back, to tell new flushes from timer re-checks
+        self.queued_windows = 0 # Flushes queued for Gemini as a window of their own
+        self._collector_task = None # Drains _window_queue into batched Gemini calls
+        self._gemini_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENT_CALLS)
+        self._inflight_analyses = set() # Running Gemini calls, kept referenced until they finish
         self._shutdown_event = asyncio.Event() # Use a separate event for processor shutdown
 
-        # Open the output file for appending received raw logs
-        # Ensure the directory exists if using subdirectories
+        # Raw NDJSON frames, as received, waiting to be appended to OUTPUT_LOG_FILE by the writer task.
+        # Bounded so a slow disk cannot grow memory without limit.
+        self._write_queue = asyncio.Queue(maxsize=OUTPUT_LOG_QUEUE_MAX_LINES)
+        self._writer_task = None
+        self.dropped_output_lines = 0
+
+    def add_log_entries(self, log_entries):
+        """Adds several parsed log entries to the buffer in one call."""
+        buffered_before = len(self._log_buffer)
+        self._log_buffer.extend(log_entries)
+        buffered_after = len(self._log_buffer)
+        # Wake the background task instead of waiting for its timer: once when the buffer fills up,
+        # and again when a buffer held back for coalescing reaches its size cap
+        if (buffered_before < MAX_LOG_BATCH_SIZE <= buffered_after
+                or buffered_before < WINDOW_COALESCE_MAX_ENTRIES <= buffered_after):
+            self._flush_now.set()
+
+    def write_raw_frame(self, frame):
+        """
+        Queues one WebSocket frame, exactly as received, for the file writer; no disk I/O on this path.
+        Binary frames are written as is, so the raw file costs no re-encoding of decoded entries.
+        """
+        if self._writer_task is None or self._writer_task.done():
+            return
+        if isinstance(frame, str):
+            frame = frame.encode()
+        if not frame.endswith(b'\n'):
+            frame += b'\n'
+        try:
+            self._write_queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            # The raw file is best-effort; analysis must not wait on the disk
+            self.dropped_output_lines += 1
+            if self.dropped_output_lines % 1000 == 1:
+                logger.warning("Output log writer is behind, dropped %d raw log frames so far.", self.dropped_output_lines)
+
+    def enqueue_log_entries(self, log_entries: list):
+        """
+        Queues one WebSocket message's entries for the ingest task. Never blocks:
+        when the queue is full the oldest message is dropped to make room.
+        """
         try:
-            if OUTPUT_LOG_FILE:
-                 # Use 'a' mode for append, 'w' would overwrite
-                self._output_file = open(OUTPUT_LOG_FILE, 'a')
-            else:
-                self._output_file = None
-        except IOError as e:
-            print(f"Error opening output log file {OUTPUT_LOG_FILE}: {e}")
-            self._output_file = None
-
-    def add_log_entry(self, log_entry: dict):
-        """Adds a parsed log entry to the buffer."""
-        self._log_buffer.append(log_entry)
-        # Optionally write raw log line to file
-        if self._output_file:
-            try:
-                # Assuming log_entry is already a dictionary parsed from JSON line
-                # Convert back to JSON string for NDJSON file format
-                self._output_file.write(json.dumps(log_entry) + '\n')
-                self._output_file.flush() # Ensure it's written immediately
-            except Exception as e:
-                print(f"Error writing log entry to file: {e}")
-
-    async def process_buffer(self):
-        """Processes the buffer, sending batches to Gemini."""
+            self.queue.put_nowait(log_entries)
+        except asyncio.QueueFull:
+            self.queue.get_nowait()
+            self.queue.put_nowait(log_entries)
+            self.dropped_log_messages += 1
+            if self.dropped_log_messages % 1000 == 1:
+                logger.warning("Log processor is behind, dropped %d queued log messages so far.", self.dropped_log_messages)
+
+    async def _ingest_consumer(self):
+        """Moves entries queued by the receiver into the buffer, draining everything ready per wakeup."""
+        while True:
+            self.add_log_entries(await self.queue.get())
+            while not self.queue.empty():
+                self.add_log_entries(self.queue.get_nowait())
+
+    async def _file_writer(self):
+        """
+        Appends queued log frames to OUTPUT_LOG_FILE, coalescing everything queued within
+        OUTPUT_LOG_WRITE_INTERVAL_SECONDS into a single writelines() call, flushed to the OS right after.
+        A None item stops the writer, which then fsyncs the file once before closing it.
+        """
+        try:
+            # 64 KiB buffer: a batch is written out in one write() when it is flushed
+            async with aiofiles.open(OUTPUT_LOG_FILE, 'ab', buffering=1 << 16) as output_file:
+                stopping = False
+                while not stopping:
+                    line = await self._write_queue.get()
+                    if line is None:
+                        break
+                    await asyncio.sleep(OUTPUT_LOG_WRITE_INTERVAL_SECONDS) # Let more lines pile up
+
+                    lines = [line]
+                    while not self._write_queue.empty():
+                        line = self._write_queue.get_nowait()
+                        if line is None:
+                            stopping = True
+                            break
+                        lines.append(line)
+
+                    await output_file.writelines(lines) # One executor hop per batch, no joined copy
+                    # Hand each batch to the OS, so a crash or kill loses at most what is still queued
+                    await output_file.flush()
+
+                await output_file.flush()
+                await asyncio.to_thread(os.fsync, output_file.fileno())
+        except OSError as e:
+            logger.error("Error writing output log file %s: %s", OUTPUT_LOG_FILE, e)
+
+    def _should_coalesce(self, window_ips: frozenset, now: float) -> bool:
+        """
+        True if the buffer looks like the previous window (Jaccard similarity of their top
+        client IPs above the threshold) and has not been held back for too long already.
+        """
+        if len(self._log_buffer) >= WINDOW_COALESCE_MAX_ENTRIES:
+            return False # Bounds the buffer, and the scans over it, while attack traffic keeps the same IPs
+        union = window_ips | self._last_window_ips
+        if not union or len(window_ips & self._last_window_ips) / len(union) <= WINDOW_COALESCE_JACCARD_THRESHOLD:
+            return False
+        if self._deferred_since is None:
+            self._deferred_since = now
+        return now - self._deferred_since < WINDOW_COALESCE_MAX_DELAY_SECONDS
+
+    async def process_buffer(self, coalesce: bool = True):
+        """
+        Takes the buffered entries as one window and queues it for Gemini analysis.
+        With coalesce, a buffer dominated by the same IPs as the previous window is kept
+        and merged into the next flush instead, saving a near-duplicate Gemini call.
+        """
         if not self._log_buffer:
             return
 
-        print(f"Processing buffer: {len(self._log_buffer)} entries.")
-        # Take a batch and clear the buffer immediately
-        batch_to_process = self._log_buffer[:]
+        now = time.monotonic()
+        if not has_signal(self._log_buffer):
+            # Nothing blocked, failed or suspicious: skip the window instead of queueing it for Gemini
+            logger.debug("Skipping buffer of %d entries, no high-signal events.", len(self._log_buffer))
+            self._log_buffer = []
+            self._last_flush_time = now
+            self._deferred_since = None
+            self._held_entries = 0
+            return
+
+        window_ips = _top_client_ips(self._log_buffer)
+        if coalesce and self._should_coalesce(window_ips, now):
+            # Only a flush that brought new entries is merged; re-checking an unchanged held buffer is not
+            if len(self._log_buffer) > self._held_entries:
+                self.coalesced_flushes += 1
+            self._held_entries = len(self._log_buffer)
+            self._last_flush_time = now # Retry on the next flush interval
+            logger.debug("Holding %d entries for the next window, same top IPs as the last one "
+                         "(%d flushes coalesced so far).", len(self._log_buffer), self.coalesced_flushes)
+            return
+
+        logger.debug("Processing buffer: %d entries.", len(self._log_buffer))
+        # Hand the buffer list itself over as the batch and start a fresh one, no copy
+        batch_to_process = self._log_buffer
         self._log_buffer = []
-        self._last_flush_time = time.time()
+        self._last_flush_time = now
+        self._last_window_ips = window_ips
+        self._deferred_since = None
+        self._held_entries = 0
+        self.queued_windows += 1
+        if self.queued_windows % 100 == 0:
+            self._log_coalescing_stats()
+
+        try:
+            self._window_queue.put_nowait(batch_to_process)
+        except asyncio.QueueFull:
+            # Analysis is behind; the newest window is the most relevant one, drop the oldest
+            self._window_queue.get_nowait()
+            self._window_queue.task_done()
+            self._window_queue.put_nowait(batch_to_process)
+            self.dropped_windows += 1
+            if self.dropped_windows % 100 == 1:
+                logger.warning("Gemini analysis is behind, dropped %d queued log windows so far.", self.dropped_windows)
 
-        # Analyze the batch
-        threats = await self.gemini_client.analyze_logs(batch_to_process)
+    def _log_coalescing_stats(self):
+        """Logs how many flushes were coalesced into a later window instead of costing a Gemini window."""
+        flushes = self.coalesced_flushes + self.queued_windows
+        if flushes:
+            logger.info("Window coalescing: %d of %d flushes coalesced (%.0f%%), %d windows queued for Gemini.",
+                        self.coalesced_flushes, flushes, 100 * self.coalesced_flushes / flushes, self.queued_windows)
 
+    def _report_threats(self, threats: list):
+        """Logs the threats found in one Gemini call, one record per threat."""
         if threats:
-            print(f"--- Detected Threats ({len(threats)}) ---")
+            logger.warning("--- Detected Threats (%d) ---", len(threats))
             for threat in threats:
-                print(f"  Entity Type: {threat.get('entity_type', 'N/A')}")
-                print(f"  Entity Value: {threat.get('entity_value', 'N/A')}")
-                print(f"  Reason: {threat.get('reason', 'N/A')}")
-                print(f"  Suggested Action: {threat.get('suggested_action', 'N/A')}")
-                print(f"  Confidence Score: {threat.get('confidence_score', 'N/A')}")
-                print("-" * 10) # Separator for threats
+                logger.warning(
+                    "Entity Type: %s | Entity Value: %s | Reason: %s | Suggested Action: %s | Confidence Score: %s | Source Window: %s",
+                    threat.get('entity_type', 'N/A'), threat.get('entity_value', 'N/A'), threat.get('reason', 'N/A'),
+                    threat.get('suggested_action', 'N/A'), threat.get('confidence_score', 'N/A'),
+                    threat.get('source_window_id', 'N/A'),
+                )
         else:
-            print("Batch processed. No threats reported by AI.")
+            logger.info("Batch processed. No threats reported by AI.")
+
+    async def _analyze_windows(self, windows: list):
+        """Runs one Gemini call for the windows, then releases its concurrency slot."""
+        try:
+            logger.debug("Analyzing %d log window(s) in one Gemini call.", len(windows))
+            threats = await self.gemini_client.analyze_windows(windows)
+            self._report_threats(threats)
+        except Exception as e:
+            logger.error("Error analyzing log windows: %s", e)
+        finally:
+            self._gemini_semaphore.release()
+            for _ in windows:
+                self._window_queue.task_done()
+
+    async def _analysis_collector(self):
+        """
+        Waits for queued windows and analyzes up to GEMINI_BATCH_MAX_WINDOWS of them
+        per Gemini call, waiting at most GEMINI_BATCH_WAIT_MS for more to arrive.
+        Each call runs as its own task, at most GEMINI_MAX_CONCURRENT_CALLS at a time,
+        so one slow Gemini response does not hold back the windows queued behind it.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            windows = [await self._window_queue.get()]
+            deadline = loop.time() + GEMINI_BATCH_WAIT_MS / 1000
+            while len(windows) < GEMINI_BATCH_MAX_WINDOWS:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    windows.append(await asyncio.wait_for(self._window_queue.get(), timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            # Waits while all slots are busy; windows arriving meanwhile join the next call
+            await self._gemini_semaphore.acquire()
+            task = asyncio.create_task(self._analyze_windows(windows))
+            self._inflight_analyses.add(task)
+            task.add_done_callback(self._inflight_analyses.discard)
 
     async def _background_processor(self):
-        """Background task to periodically check and process the buffer."""
-        print("Log processor background task started.")
-        while not self._shutdown_event.is_set():
-            await asyncio.sleep(1) # Check buffer every second
-
-            # Process if buffer is full or timeout reached
-            if len(self._log_buffer) >= MAX_LOG_BATCH_SIZE or \
-               (time.time() - self._last_flush_time >= BATCH_FLUSH_INTERVAL_SECONDS and self._log_buffer):
+        """Background task that processes the buffer when it fills up or the flush interval ends."""
+        logger.info("Log processor background task started.")
+        shutting_down = self._shutdown_event.is_set
+        while not shutting_down():
+            # Sleep until add_log_entries reports a full buffer, or the flush interval runs out
+            timeout = BATCH_FLUSH_INTERVAL_SECONDS - (time.monotonic() - self._last_flush_time)
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), timeout=max(timeout, 0))
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+
+            if self._log_buffer:
                 await self.process_buffer()
-        print("Log processor background task shutting down.")
+            else:
+                self._last_flush_time = time.monotonic() # Nothing to flush, start a new interval
+        logger.info("Log processor background task shutting down.")
 
 
     def start(self):
         """Starts the background processing task."""
         if self._processing_task is None or self._processing_task.done():
-            print("Starting Log Processor background task.")
+            logger.info("Starting Log Processor background task.")
             self._processing_task = asyncio.create_task(self._background_processor())
         else:
-            print("Log Processor background task already running.")
+            logger.info("Log Processor background task already running.")
+
+        if self._ingest_task is None or self._ingest_task.done():
+            self._ingest_task = asyncio.create_task(self._ingest_consumer())
+
+        if self._collector_task is None or self._collector_task.done():
+            self._collector_task = asyncio.create_task(self._analysis_collector())
+
+        if OUTPUT_LOG_FILE and (self._writer_task is None or self._writer_task.done()):
+            self._writer_task = asyncio.create_task(self._file_writer())
 
 
     async def stop(self):
         """Signals the background task to stop and processes any remaining logs."""
-        print("Initiating Log Processor shutdown.")
+        logger.info("Initiating Log Processor shutdown.")
         self._shutdown_event.set() # Signal shutdown to the background task
+        self._flush_now.set() # Wake it if it is waiting for the next flush
 
         # Wait for the background task to finish its current checks and exit loop
         if self._processing_task and not self._processing_task.done():
-             print("Waiting for log processor background task to finish...")
+             logger.info("Waiting for log processor background task to finish...")
              try:
                  await asyncio.wait_for(self._processing_task, timeout=5.0) # Wait a bit
              except asyncio.TimeoutError:
-                 print("Log processor background task did not finish in time, cancelling.")
+                 logger.warning("Log processor background task did not finish in time, cancelling.")
                  self._processing_task.cancel()
                  try:
                      await self._processing_task
                  except asyncio.CancelledError:
                      pass # Expected
 
+        # Move entries still waiting in the ingest queue into the buffer
+        if self._ingest_task and not self._ingest_task.done():
+            self._ingest_task.cancel()
+            try:
+                await self._ingest_task
+            except asyncio.CancelledError:
+                pass # Expected
+        while not self.queue.empty():
+            self.add_log_entries(self.queue.get_nowait())
+
         # Process any remaining logs in the buffer before exiting
         if self._log_buffer:
-            print(f"Processing {len(self._log_buffer)} remaining logs before final shutdown.")
-            await self.process_buffer()
-
-        # Close the output file if it was opened
-        if self._output_file:
-            print(f"Closing output log file: {OUTPUT_LOG_FILE}")
-            self._output_file.close()
-            self._output_file = None # Clear reference
+            logger.info("Processing %d remaining logs before final shutdown.", len(self._log_buffer))
+            await self.process_buffer(coalesce=False)
+
+        # Let the collector finish every queued window, then stop it
+        if self._collector_task and not self._collector_task.done():
+            if not self._window_queue.empty() or self._inflight_analyses:
+                logger.info("Waiting for queued log windows to be analyzed...")
+            await self._window_queue.join() # Done once every window's Gemini call has finished
+            self._collector_task.cancel()
+            try:
+                await self._collector_task
+            except asyncio.CancelledError:
+                pass # Expected
+        if self._inflight_analyses:
+            await asyncio.gather(*self._inflight_analyses, return_exceptions=True)
+
+        # Stop the file writer once it has written everything queued so far
+        if self._writer_task and not self._writer_task.done():
+            logger.info("Closing output log file: %s", OUTPUT_LOG_FILE)
+            await self._write_queue.put(None) # Waits for room if the queue is full
+            await self._writer_task
+
+        self._log_coalescing_stats()
@@ -1,87 +1,174 @@
 # websocket_handler.py
 import asyncio
+import logging
+import random
 import aiohttp
-import json
-from config import WEBSOCKET_ERROR_RETRY_DELAY_SECONDS # Import delay from config
+import msgspec
+from config import ( # Import settings from config
+    WEBSOCKET_COMPRESS, WEBSOCKET_INITIAL_RETRY_DELAY_SECONDS, WEBSOCKET_MAX_RETRY_DELAY_SECONDS,
+    SESSION_RENEWAL_INTERVAL_MINUTES
+)
+from log_entry import LOG_ENTRY_DECODER
+
+logger = logging.getLogger(__name__)
+
+# Message types looked up once at import instead of on every received message
+_TEXT = aiohttp.WSMsgType.TEXT
+_BINARY = aiohttp.WSMsgType.BINARY
+_ERROR = aiohttp.WSMsgType.ERROR
+_CLOSED = aiohttp.WSMsgType.CLOSED
+
+async def interruptible_sleep(event: asyncio.Event, timeout: float) -> bool:
+    """Sleeps up to timeout seconds, returning True early if event gets set (e.g. shutdown)."""
+    try:
+        await asyncio.wait_for(event.wait(), timeout=timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
 
 class WebSocketLogReceiver:
-    def __init__(self, websocket_url: str, session_id: str, shutdown_event: asyncio.Event, log_processor):
-        self._websocket_url = websocket_url
-        self._session_id = session_id
+    """Receives Instant Logs over WebSocket. One instance serves every session for the process lifetime."""
+    def __init__(self, shutdown_event: asyncio.Event, log_processor, aiohttp_session: aiohttp.ClientSession):
+        self._websocket_url = None # Set per Instant Logs session by start()
+        self._session_id = None
         self._shutdown_event = shutdown_event
         self._log_processor = log_processor # Reference to the log processor
-        self._ws = None # To hold the aiohttp websocket connection
-
-    async def start(self):
-        """Connects to the WebSocket and receives logs."""
-        print(f"WebSocketLogReceiver for session {self._session_id} starting connection to {self._websocket_url}")
-
-        # Use a ClientSession provided externally or create one if necessary
-        # For this integration, it's better to let main manage the aiohttp session
-        # but for simplicity here, we'll create one within the class for the websocket connection itself.
-        # A more robust design might pass the session from CloudflareLogSessionManager.
-        async with aiohttp.ClientSession() as session:
-            while not self._shutdown_event.is_set():
-                try:
-                    print(f"Attempting WebSocket connection to {self._websocket_url}")
-                    # Use a context manager for the websocket connection
-                    async with session.ws_connect(self._websocket_url) as ws:
-                        self._ws = ws # Store reference to the active connection
-                        print(f"WebSocket connected successfully for session {self._session_id}")
-
-                        # Keep receiving messages until disconnected or shutdown
-                        async for msg in ws:
-                            if msg.type == aiohttp.WSMsgType.TEXT:
-                                try:
-                                    # Each message is a newline-delimited JSON object (NDJSON)
-                                    # Split by newline to handle potential multiple logs in one message,
-                                    # though typically it's one log per message.
-                                    log_lines = msg.data.strip().split('\\n')
-                                    for line in log_lines:
-                                        if line: # Ensure line is not empty
-                                            log_entry = json.loads(line)
-                                            # Pass the parsed log entry to the processor
-                                            self._log_processor.add_log_entry(log_entry)
-
-                                except json.JSONDecodeError as e:
-                                    print(f"Error decoding log message JSON: {e} - Data: {msg.data[:200]}...")
-                                except Exception as e:
-                                    print(f"Error processing received log message: {e}")
-
-                            elif msg.type == aiohttp.WSMsgType.ERROR:
-                                print(f"WebSocket Error received: {msg.data}")
-                                break # Break loop to attempt reconnection
-                            elif msg.type == aiohttp.WSMsgType.CLOSED:
-                                print(f"WebSocket connection closed with code {ws.close_code}: {ws.close_message}")
-                                break # Break loop to attempt reconnection
-
-                        # If we break out of the async for loop, the connection is closed
-                        print(f"WebSocket connection for session {self._session_id} closed. Attempting to re-establish or waiting for new session.")
-
-                except aiohttp.ClientConnectorError as e:
-                    print(f"WebSocket connection failed: {e}. Retrying in {WEBSOCKET_ERROR_RETRY_DELAY_SECONDS} seconds.")
-                    # Connection error, wait and the outer loop will attempt to reconnect
-
-                except Exception as e:
-                    print(f"An unexpected error occurred in WebSocketLogReceiver: {e}")
-                    # Catch other exceptions, wait and retry
-
-                # If shutdown is requested while waiting or during error
-                if self._shutdown_event.is_set():
-                    print("Shutdown event detected in WebSocket receiver.")
-                    break
-
-                # Wait before attempting reconnection or requesting a new session
-                print(f"Waiting {WEBSOCKET_ERROR_RETRY_DELAY_SECONDS} seconds before attempting reconnect/new session...")
-                await asyncio.sleep(WEBSOCKET_ERROR_RETRY_DELAY_SECONDS)
-
-        print(f"WebSocketLogReceiver for session {self._session_id} shutting down.")
-        # The aiohttp ClientSession context manager will close the session on exit
+        self._ws = None # The open aiohttp websocket connection, None between connections
+        self._stopping = False # Set by stop(); ends the receive loop without reconnecting
+        self._session_expired = False # Set by the renewal timer; start() returns so a new session is created
+        self._expire_close_task = None # Closes the connection when the session expires
+        self._retry_delay = WEBSOCKET_INITIAL_RETRY_DELAY_SECONDS # Reconnect backoff, kept across sessions
+        self._session = aiohttp_session # Shared with CloudflareLogSessionManager, owned by it
+
+    async def start(self, websocket_url: str, session_id: str) -> bool:
+        """
+        Connects to the WebSocket of the given Instant Logs session and receives logs until stopped.
+        Returns True if it ended because the session reached its renewal interval, so the caller
+        can create the next session right away instead of treating it as a failure.
+        """
+        self._websocket_url = websocket_url
+        self._session_id = session_id
+        self._stopping = False
+        self._session_expired = False
+        logger.info("WebSocketLogReceiver for session %s starting connection to %s", self._session_id, self._websocket_url)
+
+        # Renewal is one timer on the loop's monotonic clock, so the receive loop never checks the time
+        loop = asyncio.get_running_loop()
+        renewal_timer = loop.call_at(loop.time() + SESSION_RENEWAL_INTERVAL_MINUTES * 60, self._expire_session)
+        try:
+            await self._receive()
+        finally:
+            renewal_timer.cancel()
+            if self._expire_close_task is not None:
+                # Normally done already: the receive loop only ends once the close went through
+                await asyncio.gather(self._expire_close_task, return_exceptions=True)
+                self._expire_close_task = None
+
+        logger.info("WebSocketLogReceiver for session %s shutting down.", self._session_id)
+        return self._session_expired
+
+    def _expire_session(self):
+        """Renewal timer callback: ends the current session so the pipeline requests a new one."""
+        logger.info("Session %s reached its %s minute renewal interval, closing it.", self._session_id, SESSION_RENEWAL_INTERVAL_MINUTES)
+        self._session_expired = True
+        ws = self._ws
+        if ws is not None and not ws.closed:
+            self._expire_close_task = asyncio.create_task(ws.close())
+
+    async def _receive(self):
+        """Receives logs of the current session, reconnecting with backoff until stopped or expired."""
+        shutting_down = self._shutdown_event.is_set # Bound once, checked on every reconnect
+        initial_retry_delay = WEBSOCKET_INITIAL_RETRY_DELAY_SECONDS
+        retry_delay = self._retry_delay
+        while not shutting_down() and not self._stopping and not self._session_expired:
+            try:
+                logger.info("Attempting WebSocket connection to %s", self._websocket_url)
+                # Use a context manager for the websocket connection.
+                # max_msg_size=0 lifts the 4 MiB cap for large bursts. No client heartbeat: the stream
+                # is server-push only and a broken connection surfaces as a CLOSED/ERROR message.
+                async with self._session.ws_connect(
+                    self._websocket_url, compress=WEBSOCKET_COMPRESS, max_msg_size=0, autoclose=True, heartbeat=None
+                ) as ws:
+                    self._ws = ws # Store reference to the active connection
+                    if self._session_expired:
+                        break # The renewal timer fired while connecting, when there was no connection to close
+                    logger.info("WebSocket connected successfully for session %s", self._session_id)
+
+                    # Bound once per connection, used for every message below
+                    decode_lines = LOG_ENTRY_DECODER.decode_lines
+                    enqueue = self._log_processor.enqueue_log_entries
+                    write_raw_frame = self._log_processor.write_raw_frame
+
+                    # Keep receiving messages until disconnected or shutdown
+                    async for msg in ws:
+                        msg_type = msg.type
+                        if msg_type is _TEXT or msg_type is _BINARY:
+                            retry_delay = initial_retry_delay # Data is flowing again, reset the backoff
+                            write_raw_frame(msg.data) # Raw file gets the frame as received, before decoding
+                            try:
+                                # Each message is newline-delimited JSON (NDJSON), typically one log per
+                                # message but possibly several. decode_lines parses the whole frame in one
+                                # call, skipping blank lines; binary frames are decoded without a UTF-8 pass.
+                                # The entries are queued for the processor in one non-blocking call
+                                # per message so the socket keeps draining.
+                                enqueue(decode_lines(msg.data))
+
+                            except msgspec.DecodeError as e: # Also raised for records that don't fit the LogEntry schema
+                                logger.warning("Error decoding log message JSON: %s", e)
+                                # Payload only at DEBUG; %.200s truncates lazily, no slice unless it is emitted
+                                logger.debug("Undecodable log message data: %.200s", msg.data)
+                            except Exception as e:
+                                logger.error("Error processing received log message: %s", e)
+
+                        elif msg_type is _ERROR:
+                            logger.warning("WebSocket Error received: %s", msg.data)
+                            break # Break loop to attempt reconnection
+                        elif msg_type is _CLOSED:
+                            logger.info("WebSocket connection closed with code %s: %s", ws.close_code, ws.close_message)
+                            break # Break loop to attempt reconnection
+
+                    # If we break out of the async for loop, the connection is closed
+                    logger.info("WebSocket connection for session %s closed. Attempting to re-establish or waiting for new session.", self._session_id)
+
+            except aiohttp.ClientConnectorError as e:
+                logger.warning("WebSocket connection failed: %s. Retrying in %.1f seconds.", e, retry_delay)
+                # Connection error, wait and the outer loop will attempt to reconnect
+
+            except Exception as e:
+                logger.error("An unexpected error occurred in WebSocketLogReceiver: %s", e)
+                # Catch other exceptions, wait and retry
+            finally:
+                self._ws = None # The context manager has closed it, stop() has nothing left to close
+
+            # If shutdown is requested while waiting or during error
+            if shutting_down() or self._stopping:
+                logger.info("Shutdown event detected in WebSocket receiver.")
+                break
+            if self._session_expired:
+                break # Reconnecting to an expired session is pointless, let the pipeline renew it
+
+            # Wait before attempting reconnection or requesting a new session
+            logger.info("Waiting %.1f seconds before attempting reconnect/new session...", retry_delay)
+            if await interruptible_sleep(self._shutdown_event, retry_delay):
+                logger.info("Shutdown event detected in WebSocket receiver.")
+                break
+            # Exponential backoff with jitter, so reconnects don't hammer a recovering endpoint in lockstep
+            retry_delay = min(retry_delay * 2 * random.uniform(0.8, 1.2), WEBSOCKET_MAX_RETRY_DELAY_SECONDS)
 
+        self._retry_delay = retry_delay
 
     async def stop(self):
-        """Gracefully closes the WebSocket connection."""
-        print(f"Stopping WebSocketLogReceiver for session {self._session_id}.")
-        if self._ws and not self._ws.closed:
-            await self._ws.close()
-            print(f"WebSocket connection for session {self._session_id} closed gracefully.")
+        """
+        Stops the receiver from reconnecting and closes the WebSocket if it is still open.
+        In the common case start() has already returned and its context manager closed the
+        connection, so there is nothing to close; otherwise the close is bounded to 1 second.
+        """
+        logger.info("Stopping WebSocketLogReceiver for session %s.", self._session_id)
+        self._stopping = True
+        ws = self._ws
+        if ws is not None and not ws.closed:
+            try:
+                await asyncio.wait_for(ws.close(), timeout=1)
+                logger.info("WebSocket connection for session %s closed gracefully.", self._session_id)
+            except asyncio.TimeoutError:
+                logger.warning("Timed out closing WebSocket connection for session %s.", self._session_id)